@@ -3,15 +3,86 @@ import json
 import logging
 import os
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from pathlib import Path
 from typing import Iterable, List, Set, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import setup_order_db
+from jsonutil import json_dumps, json_loads
 
 DEFAULT_PRODUCTS: List[str] = ["3d-Christmas-Tree-Ornament"]
 REQUEST_TIMEOUT = 30
+MAX_FETCH_WORKERS = 8
+
+CUSTOM_FIELD1_KEYS = ("customField1", "custom_field1")
+ITEM_NOTE_KEYS = ("buyerNotes", "customerNotes", "note_from_buyer", "noteFromBuyer")
+JSON_DATA_NOTE_KEYS = ("customerNotes", "note_from_buyer", "noteFromBuyer")
+ORDER_NOTE_KEYS = ("customerNotes", "giftMessage")
+
+UPSERT_SQL = """
+INSERT INTO order_items (order_number, order_id, item_id, raw_json, shipped, file_found, product, quantity, options, custom_field1, buyer_note, year)
+VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(order_number, item_id) DO UPDATE SET
+    raw_json = excluded.raw_json,
+    order_id = excluded.order_id,
+    shipped = 0,
+    file_found = excluded.file_found,
+    product = excluded.product,
+    quantity = excluded.quantity,
+    options = excluded.options,
+    custom_field1 = excluded.custom_field1,
+    buyer_note = excluded.buyer_note,
+    -- Once parsed, the year is the model's answer and is left alone.
+    year = CASE WHEN order_items.names IS NULL OR order_items.names = '' THEN excluded.year ELSE order_items.year END,
+    updated_at = CURRENT_TIMESTAMP
+"""
+
+CREATE_ACTIVE_ITEMS_SQL = """
+CREATE TEMP TABLE active_items (
+    order_number TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    PRIMARY KEY (order_number, item_id)
+) WITHOUT ROWID
+"""
+
+INSERT_ACTIVE_ITEM_SQL = "INSERT OR IGNORE INTO active_items VALUES (?, ?)"
+
+MARK_SHIPPED_SQL = """
+UPDATE order_items
+SET shipped = 1, updated_at = CURRENT_TIMESTAMP
+WHERE shipped = 0
+  AND NOT EXISTS (
+      SELECT 1 FROM active_items a
+      WHERE a.order_number = order_items.order_number AND a.item_id = order_items.item_id
+  )
+"""
+
+UNMARK_SHIPPED_SQL = """
+UPDATE order_items
+SET shipped = 0, updated_at = CURRENT_TIMESTAMP
+WHERE shipped = 1
+  AND EXISTS (
+      SELECT 1 FROM active_items a
+      WHERE a.order_number = order_items.order_number AND a.item_id = order_items.item_id
+  )
+"""
+
+
+def build_session() -> requests.Session:
+    retry = Retry(total=2, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_FETCH_WORKERS, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+SESSION = build_session()
 
 
 def configure_logging(verbose: bool) -> None:
@@ -39,7 +110,7 @@ def fetch_orders(product: str) -> List[dict]:
     logging.debug("Requesting %s orders from %s", product, url)
 
     try:
-        response = requests.get(
+        response = SESSION.get(
             url,
             params={"product": product},
             timeout=REQUEST_TIMEOUT,
@@ -49,7 +120,7 @@ def fetch_orders(product: str) -> List[dict]:
         logging.error("Failed to fetch orders for %s: %s", product, exc)
         raise
 
-    payload = response.json()
+    payload = json_loads(response.content)
     if not isinstance(payload, list):
         logging.error("Unexpected payload for %s: %s", product, payload)
         raise ValueError("API must return a list of orders.")
@@ -57,12 +128,20 @@ def fetch_orders(product: str) -> List[dict]:
     return payload
 
 
+def fetch_all_orders(products: List[str]) -> List[List[dict]]:
+    if len(products) <= 1:
+        return [fetch_orders(product) for product in products]
+    with ThreadPoolExecutor(max_workers=min(len(products), MAX_FETCH_WORKERS)) as executor:
+        return list(executor.map(fetch_orders, products))
+
+
 def ensure_dict(value):
     if isinstance(value, dict):
         return value
-    if isinstance(value, str):
+    # Only an object literal can decode to a dict, so skip the parser otherwise.
+    if isinstance(value, str) and value.lstrip().startswith("{"):
         try:
-            parsed = json.loads(value)
+            parsed = json_loads(value)
             if isinstance(parsed, dict):
                 return parsed
         except (TypeError, ValueError, json.JSONDecodeError):
@@ -101,42 +180,40 @@ def extract_options(item: dict, json_data: dict) -> str:
         options = json_data.get("options")
     if options is None:
         return "[]"
+    # Options that arrive as a JSON string are stored as-is instead of being
+    # re-encoded into a quoted string.
+    if isinstance(options, str) and options.lstrip().startswith(("[", "{")):
+        return options
     try:
-        return json.dumps(options, ensure_ascii=False, separators=(",", ":"))
+        return json_dumps(options)
     except TypeError:
         return "[]"
 
 
-def extract_custom_field1(order: dict, item: dict, json_data: dict) -> str:
-    for key in ("customField1", "custom_field1"):
-        value = item.get(key)
-        if isinstance(value, str) and value.strip():
-            return value.strip()
-    order_cf1 = order.get("advancedOptions", {}).get("customField1")
-    if isinstance(order_cf1, str) and order_cf1.strip():
-        return order_cf1.strip()
-    json_cf1 = json_data.get("customField1") or json_data.get("custom_field1")
-    if isinstance(json_cf1, str) and json_cf1.strip():
-        return json_cf1.strip()
+def first_nonblank(mapping: dict, keys: Tuple[str, ...]) -> str:
+    for key in keys:
+        value = mapping.get(key)
+        if isinstance(value, str):
+            value = value.strip()
+            if value:
+                return value
     return ""
 
 
-def extract_buyer_note(order: dict, item: dict, json_data: dict) -> str:
-    for key in ("buyerNotes", "customerNotes", "note_from_buyer", "noteFromBuyer"):
-        value = item.get(key)
-        if isinstance(value, str) and value.strip():
-            return value.strip()
-
-    for key in ("customerNotes", "note_from_buyer", "noteFromBuyer"):
-        value = json_data.get(key)
-        if isinstance(value, str) and value.strip():
-            return value.strip()
+def extract_custom_field1(order: dict, item: dict, json_data: dict) -> str:
+    return (
+        first_nonblank(item, CUSTOM_FIELD1_KEYS)
+        or first_nonblank(order.get("advancedOptions") or {}, ("customField1",))
+        or first_nonblank(json_data, CUSTOM_FIELD1_KEYS)
+    )
 
-    order_note = order.get("customerNotes") or order.get("giftMessage")
-    if isinstance(order_note, str) and order_note.strip():
-        return order_note.strip()
 
-    return ""
+def extract_buyer_note(order: dict, item: dict, json_data: dict) -> str:
+    return (
+        first_nonblank(item, ITEM_NOTE_KEYS)
+        or first_nonblank(json_data, JSON_DATA_NOTE_KEYS)
+        or first_nonblank(order, ORDER_NOTE_KEYS)
+    )
 
 
 def item_has_only_customized_url_option(item: dict) -> bool:
@@ -155,10 +232,20 @@ def item_has_only_customized_url_option(item: dict) -> bool:
 def upsert_items(
     conn: sqlite3.Connection, orders: Iterable[dict], product_name: str
 ) -> Tuple[int, int, Set[Tuple[str, str]]]:
-    inserted = 0
-    updated = 0
-    active_items: Set[Tuple[str, str]] = set()
-    cur = conn.cursor()
+    rows_to_upsert: List[Tuple] = []
+
+    # Bind per-item helpers to locals; the loop below runs once per order item.
+    append_row = rows_to_upsert.append
+    skip_item = item_has_only_customized_url_option
+    dumps = json_dumps
+    get_json_data = extract_json_data
+    get_product = extract_product
+    get_quantity = extract_quantity
+    get_options = extract_options
+    get_custom_field1 = extract_custom_field1
+    get_buyer_note = extract_buyer_note
+    get_file_found = extract_file_found
+    get_year = setup_order_db.extract_year
 
     for order in orders:
         order_number = str(order.get("orderNumber") or order.get("order_number") or "").strip()
@@ -171,7 +258,7 @@ def upsert_items(
 
         items = order.get("items") or []
         for item in items:
-            if item_has_only_customized_url_option(item):
+            if skip_item(item):
                 logging.info(
                     "Skipping item %s from order %s because it is waiting for Amazon personalization.",
                     item.get("orderItemId") or item.get("itemId") or "<unknown>",
@@ -189,21 +276,17 @@ def upsert_items(
                 continue
             item_id = str(raw_item_id)
 
-            raw_json = json.dumps(item, ensure_ascii=False, separators=(",", ":"))
-            json_data = extract_json_data(item)
-            product_value = extract_product(item, json_data, product_name)
-            quantity_value = extract_quantity(item, json_data)
-            options_value = extract_options(item, json_data)
-            custom_field1_value = extract_custom_field1(order, item, json_data)
-            buyer_note_value = extract_buyer_note(order, item, json_data)
-            file_found_value = extract_file_found(item)
-
-            cur.execute(
-                """
-                INSERT INTO order_items (order_number, order_id, item_id, raw_json, shipped, file_found, product, quantity, options, custom_field1, buyer_note)
-                VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(order_number, item_id) DO NOTHING
-                """,
+            raw_json = dumps(item)
+            json_data = get_json_data(item)
+            product_value = get_product(item, json_data, product_name)
+            quantity_value = get_quantity(item, json_data)
+            options_value = get_options(item, json_data)
+            custom_field1_value = get_custom_field1(order, item, json_data)
+            buyer_note_value = get_buyer_note(order, item, json_data)
+            file_found_value = get_file_found(item)
+            year_value = get_year(item, json_data)
+
+            append_row(
                 (
                     order_number,
                     order_id,
@@ -215,34 +298,20 @@ def upsert_items(
                     options_value,
                     custom_field1_value,
                     buyer_note_value,
-                ),
-            )
-            if cur.rowcount:
-                inserted += 1
-            else:
-                cur.execute(
-                    """
-                    UPDATE order_items
-                    SET raw_json = ?, order_id = ?, shipped = 0, file_found = ?, product = ?, quantity = ?, options = ?, custom_field1 = ?, buyer_note = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE order_number = ? AND item_id = ?
-                    """,
-                    (
-                        raw_json,
-                        order_id,
-                        file_found_value,
-                        product_value,
-                        quantity_value,
-                        options_value,
-                        custom_field1_value,
-                        buyer_note_value,
-                        order_number,
-                        item_id,
-                    ),
+                    year_value,
                 )
-                if cur.rowcount:
-                    updated += 1
+            )
+
+    # (order_number, item_id) sit at positions 0 and 2 of each upsert tuple.
+    active_items: Set[Tuple[str, str]] = set(map(itemgetter(0, 2), rows_to_upsert))
 
-            active_items.add((order_number, item_id))
+    conn.execute("BEGIN IMMEDIATE")
+    # Inserts grow the table while conflicting rows are updated in place, so the
+    # row count delta splits the upserts into inserted vs updated.
+    rows_before = conn.execute("SELECT COUNT(*) FROM order_items").fetchone()[0]
+    conn.executemany(UPSERT_SQL, rows_to_upsert)
+    inserted = conn.execute("SELECT COUNT(*) FROM order_items").fetchone()[0] - rows_before
+    updated = len(rows_to_upsert) - inserted
 
     conn.commit()
     logging.info("Upserted items: inserted=%d updated=%d", inserted, updated)
@@ -250,29 +319,19 @@ def upsert_items(
 
 
 def sync_shipped_flags(conn: sqlite3.Connection, active_items: Set[Tuple[str, str]]) -> Tuple[int, int]:
-    cur = conn.cursor()
-
-    cur.execute("SELECT order_number, item_id FROM order_items WHERE shipped = 0")
-    not_shipped = {(row[0], row[1]) for row in cur.fetchall()}
-    to_mark = not_shipped - active_items
-    if to_mark:
-        cur.executemany(
-            "UPDATE order_items SET shipped = 1, updated_at = CURRENT_TIMESTAMP WHERE order_number = ? AND item_id = ?",
-            list(to_mark),
-        )
+    conn.execute("BEGIN IMMEDIATE")
 
-    cur.execute("SELECT order_number, item_id FROM order_items WHERE shipped = 1")
-    already_shipped = {(row[0], row[1]) for row in cur.fetchall()}
-    to_unmark = already_shipped & active_items
-    if to_unmark:
-        cur.executemany(
-            "UPDATE order_items SET shipped = 0, updated_at = CURRENT_TIMESTAMP WHERE order_number = ? AND item_id = ?",
-            list(to_unmark),
-        )
+    conn.execute(CREATE_ACTIVE_ITEMS_SQL)
+    try:
+        conn.executemany(INSERT_ACTIVE_ITEM_SQL, active_items)
+        marked = conn.execute(MARK_SHIPPED_SQL).rowcount
+        unmarked = conn.execute(UNMARK_SHIPPED_SQL).rowcount
+    finally:
+        conn.execute("DROP TABLE temp.active_items")
 
     conn.commit()
-    logging.info("Shipped flags updated: marked=%d unmarked=%d", len(to_mark), len(to_unmark))
-    return len(to_mark), len(to_unmark)
+    logging.info("Shipped flags updated: marked=%d unmarked=%d", marked, unmarked)
+    return marked, unmarked
 
 
 def parse_args() -> argparse.Namespace:
@@ -298,7 +357,8 @@ def main() -> None:
     configure_logging(args.verbose)
 
     setup_order_db.initialise_database(args.db_path)
-    conn = sqlite3.connect(args.db_path)
+    conn = sqlite3.connect(args.db_path, cached_statements=256)
+    setup_order_db.configure_connection(conn)
 
     try:
         products = resolve_products()
@@ -306,8 +366,7 @@ def main() -> None:
         total_inserted = 0
         total_updated = 0
 
-        for product in products:
-            orders = fetch_orders(product)
+        for product, orders in zip(products, fetch_all_orders(products)):
             inserted, updated, active_items = upsert_items(conn, orders, product)
             total_inserted += inserted
             total_updated += updated
@@ -10,13 +10,22 @@ import sqlite3
 import subprocess
 import sys
 import time
+from functools import lru_cache
 from pathlib import Path
-from typing import Iterable, List, Optional, Sequence
+from typing import Iterable, List, Optional, Sequence, Set, Tuple
+
+import setup_order_db
+from jsonutil import json_loads
 
 PROJECT_ROOT = Path(__file__).resolve().parent
 DEFAULT_PRODUCT = "3d-Christmas-Tree-Ornament"
 DEFAULT_JSX = PROJECT_ROOT / "scripts" / "make_3d_tree.jsx"
 DATA_JSON = PROJECT_ROOT / "data" / "tree_data.json"
+# Illustrator writes each PDF after the "-s" launcher returns; this is how long
+# to wait for the next output before treating the rest as missing.
+OUTPUT_GRACE_SECONDS = float(os.getenv("OUTPUT_GRACE_SECONDS", "5"))
+OUTPUT_POLL_INITIAL_DELAY = 0.05
+OUTPUT_POLL_MAX_DELAY = 1.6
 DEFAULT_ILLUSTRATOR = Path(
     os.getenv(
         "ILLUSTRATOR_PATH",
@@ -30,9 +39,29 @@ SAVE_DIR = Path(
     )
 ).expanduser().resolve()
 
+MARK_GENERATED_SQL = """
+UPDATE order_items
+SET
+    is_generated = 1,
+    generation_error = NULL,
+    output_filename = ?,
+    updated_at = CURRENT_TIMESTAMP
+WHERE id = ?
+"""
+
+MARK_FAILED_SQL = """
+UPDATE order_items
+SET
+    is_generated = 0,
+    generation_error = ?,
+    output_filename = NULL,
+    updated_at = CURRENT_TIMESTAMP
+WHERE id = ?
+"""
+
 
 def parse_id_selector(selector: str) -> List[int]:
-    values: List[int] = []
+    values: Set[int] = set()
     for part in selector.split(","):
         part = part.strip()
         if not part:
@@ -43,12 +72,13 @@ def parse_id_selector(selector: str) -> List[int]:
             end = int(end_str, 10)
             if end < start:
                 start, end = end, start
-            values.extend(range(start, end + 1))
+            values.update(range(start, end + 1))
         else:
-            values.append(int(part, 10))
-    return sorted(set(values))
+            values.add(int(part, 10))
+    return sorted(values)
 
 
+@lru_cache(maxsize=4)
 def ensure_paths(illustrator_path: Path, jsx_path: Path) -> tuple[Path, Path, Path]:
     illustrator_path = illustrator_path.expanduser().resolve()
     if not illustrator_path.exists():
@@ -110,63 +140,97 @@ def load_rows(
 
 
 def normalise_names(value: str) -> List[str]:
-    try:
-        data = json.loads(value)
-        if isinstance(data, list):
-            return [str(item).strip() for item in data if str(item).strip()]
-    except json.JSONDecodeError:
-        pass
+    if value.lstrip().startswith("["):
+        try:
+            data = json_loads(value)
+            if isinstance(data, list):
+                return [str(item).strip() for item in data if str(item).strip()]
+        except json.JSONDecodeError:
+            pass
     return [segment.strip() for segment in value.split(",") if segment.strip()]
 
 
-def write_job_json(data_path: Path, names: List[str], layer_name: str, filename: str) -> None:
-    payload = {
+def build_job(names: List[str], layer_name: str, filename: str) -> dict:
+    return {
         "names": names,
         "name": names,
         "layerName": layer_name,
         "filename": filename,
     }
+
+
+def write_job_batch(data_path: Path, jobs: List[dict]) -> None:
+    payload = {"jobs": jobs}
     data_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
 
 
-def run_illustrator(illustrator_path: Path, jsx_path: Path) -> None:
+def output_signature(path: Path) -> Optional[tuple[int, int]]:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def wait_for_outputs(previous: dict[Path, Optional[tuple[int, int]]], grace: float) -> Set[Path]:
+    """Poll with backoff for rewritten, non-empty outputs and return the ones that were.
+
+    Polling stops once every output is rewritten or ``grace`` seconds pass without
+    a new one appearing, so a missing PDF costs one grace period per run.
+    """
+
+    deadline = time.monotonic() + grace
+    delay = OUTPUT_POLL_INITIAL_DELAY
+    waiting = dict(previous)
+    while True:
+        for path, before in list(waiting.items()):
+            current = output_signature(path)
+            if current is not None and current[1] > 0 and current != before:
+                del waiting[path]
+                deadline = time.monotonic() + grace
+        if not waiting or time.monotonic() >= deadline:
+            return set(previous) - set(waiting)
+        time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+        delay = min(delay * 2, OUTPUT_POLL_MAX_DELAY)
+
+
+def run_illustrator(
+    illustrator_path: Path, jsx_path: Path, expected_outputs: Sequence[Path]
+) -> Tuple[Set[Path], Optional[str]]:
+    """Render the job batch and return the outputs it rewrote plus the launcher error, if any.
+
+    Outputs are collected even when the launch fails or times out, since earlier
+    jobs in the batch may already have been saved.
+    """
     print('run_illustrator started')
-    result = subprocess.run(
-        [str(illustrator_path), "-s", str(jsx_path)],
-        cwd=str(PROJECT_ROOT),
-        check=True,
-        timeout=17,
-    )
-    time.sleep(5)
+    previous = {path: output_signature(path) for path in expected_outputs}
+    job_count = max(len(expected_outputs), 1)
+    error: Optional[str] = None
+    try:
+        result = subprocess.run(
+            [str(illustrator_path), "-s", str(jsx_path)],
+            cwd=str(PROJECT_ROOT),
+            check=True,
+            timeout=17 * job_count,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Illustrator exited with code {result.returncode}")
+    except Exception as exc:  # noqa: BLE001
+        error = str(exc)
+    rewritten = wait_for_outputs(previous, OUTPUT_GRACE_SECONDS)
     print('run_illustrator ended')
-    if result.returncode != 0:
-        raise RuntimeError(f"Illustrator exited with code {result.returncode}")
+    return rewritten, error
 
 
-def update_row(
+def save_results(
     cursor: sqlite3.Cursor,
-    row_id: int,
-    filename: str,
-    success: bool,
-    error: Optional[str],
+    successes: List[Tuple[str, int]],
+    failures: List[Tuple[str, int]],
 ) -> None:
-    cursor.execute(
-        """
-        UPDATE order_items
-        SET
-            is_generated = ?,
-            generation_error = ?,
-            output_filename = ?,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE id = ?
-        """,
-        (
-            int(success),
-            None if success else (error or ""),
-            filename if success else None,
-            row_id,
-        ),
-    )
+    if successes:
+        cursor.executemany(MARK_GENERATED_SQL, successes)
+    if failures:
+        cursor.executemany(MARK_FAILED_SQL, failures)
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -223,6 +287,7 @@ def main(argv: Optional[Iterable[str]] = None) -> int:
     illustrator_path, jsx_path, data_json_path = ensure_paths(args.illustrator, args.jsx)
 
     conn = sqlite3.connect(args.db_path)
+    setup_order_db.configure_connection(conn)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
 
@@ -242,12 +307,16 @@ def main(argv: Optional[Iterable[str]] = None) -> int:
 
         generated = 0
         failures = 0
+        pending: List[tuple[sqlite3.Row, List[str], dict]] = []
+        # (output_filename | error, row id) pairs, written in one batch after the Illustrator run.
+        success_updates: List[Tuple[str, int]] = []
+        failure_updates: List[Tuple[str, int]] = []
 
         for row in rows:
             names = normalise_names(row["names"])
             if not names:
                 logging.warning("Skipping row %s because names list is empty.", row["id"])
-                update_row(cursor, row["id"], "", False, "Empty names list")
+                failure_updates.append(("Empty names list", row["id"]))
                 failures += 1
                 continue
 
@@ -255,35 +324,68 @@ def main(argv: Optional[Iterable[str]] = None) -> int:
             names_with_year = [year] + names
             layer_name = str(len(names_with_year))
             filename = f"{row['order_number']}_{row['item_id']}.pdf"
-            save_path = SAVE_DIR / filename
 
+            if len(names) > 10:
+                failures += 1
+                logging.error(
+                    "Failed to generate row %s (order %s, item %s): %s",
+                    row["id"],
+                    row["order_number"],
+                    row["item_id"],
+                    "Too Many Names",
+                )
+                failure_updates.append(("Too Many Names", row["id"]))
+                continue
+
+            pending.append((row, names, build_job(names_with_year, layer_name, filename)))
+
+        # One Illustrator launch renders every pending job; outputs are checked afterwards.
+        batch_error: Optional[str] = None
+        rewritten: Set[Path] = set()
+        if pending:
             try:
-                if len(names) > 10:
-                    raise FileNotFoundError('Too Many Names')
-
-                write_job_json(data_json_path, names_with_year, layer_name, filename)
-                run_illustrator(illustrator_path, jsx_path)
-                if not save_path.exists():
-                    raise FileNotFoundError(f"Expected file not found: {save_path}")
-                update_row(cursor, row["id"], filename, True, None)
+                write_job_batch(data_json_path, [job for _, _, job in pending])
+            except Exception as exc:  # noqa: BLE001
+                batch_error = str(exc)
+            else:
+                rewritten, batch_error = run_illustrator(
+                    illustrator_path,
+                    jsx_path,
+                    [SAVE_DIR / job["filename"] for _, _, job in pending],
+                )
+
+        for row, names, job in pending:
+            filename = job["filename"]
+            save_path = SAVE_DIR / filename
+
+            # Only a file this run rewrote counts; a stale PDF from an earlier run
+            # does not, and a failed launch may still have rendered some jobs.
+            error = None
+            if save_path not in rewritten:
+                error = batch_error or f"Expected file not found: {save_path}"
+
+            if error is None:
+                success_updates.append((filename, row["id"]))
                 generated += 1
 
                 if args.verbose:
                     print("=" * 60)
                     print(f"Row {row['id']} | Order {row['order_number']} | Item {row['item_id']}")
                     print(f"Names: {', '.join(names)}")
-                    print(f"Layer: {layer_name}")
+                    print(f"Layer: {job['layerName']}")
                     print(f"Output: {filename}")
-            except Exception as exc:  # noqa: BLE001
+            else:
                 failures += 1
                 logging.error(
                     "Failed to generate row %s (order %s, item %s): %s",
                     row["id"],
                     row["order_number"],
                     row["item_id"],
-                    exc,
+                    error,
                 )
-                update_row(cursor, row["id"], filename, False, str(exc))
+                failure_updates.append((error, row["id"]))
+
+        save_results(cursor, success_updates, failure_updates)
 
         if not args.dry_run:
             conn.commit()
@@ -0,0 +1,57 @@
+"""SQLite-backed cache of model responses keyed by prompt and model."""
+
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+from typing import Dict, List, Optional
+
+from jsonutil import json_dumps
+
+from . import config
+
+SELECT_CACHE_SQL = "SELECT response FROM gpt_cache WHERE prompt_hash = ?"
+
+UPSERT_CACHE_SQL = """
+INSERT INTO gpt_cache (prompt_hash, response) VALUES (?, ?)
+ON CONFLICT(prompt_hash) DO UPDATE SET
+    response = excluded.response,
+    created_at = CURRENT_TIMESTAMP
+"""
+
+
+class ResponseCache:
+    """Store single-order responses so identical prompts skip the API.
+
+    New responses are buffered until :meth:`flush` writes them inside the
+    caller's transaction. The ``gpt_cache`` table comes from
+    ``setup_order_db.ensure_schema``.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, read_only: bool = False) -> None:
+        self._conn = conn
+        self._read_only = read_only
+        self._pending: Dict[str, str] = {}
+
+    @staticmethod
+    def key(messages: List[Dict[str, str]]) -> str:
+        payload = json_dumps({"model": config.get_settings().model, "messages": messages})
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, messages: List[Dict[str, str]]) -> Optional[str]:
+        key = self.key(messages)
+        if key in self._pending:
+            return self._pending[key]
+        row = self._conn.execute(SELECT_CACHE_SQL, (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, messages: List[Dict[str, str]], response: str) -> None:
+        if self._read_only:
+            return
+        self._pending[self.key(messages)] = response
+
+    def flush(self) -> None:
+        """Write buffered responses with one executemany; the caller commits."""
+        if self._pending:
+            self._conn.executemany(UPSERT_CACHE_SQL, self._pending.items())
+            self._pending.clear()
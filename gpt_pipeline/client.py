@@ -2,59 +2,102 @@
 
 from __future__ import annotations
 
+import asyncio
 import time
-from typing import Dict, List
+from functools import lru_cache
+from typing import Dict, List, Optional
 
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI, OpenAI
 
 from . import config
 
+try:  # HTTP/2 multiplexing needs the optional h2 package.
+    import h2  # noqa: F401
+except ImportError:  # pragma: no cover - optional dependency
+    _HTTP2 = False
+else:
+    _HTTP2 = True
+
+_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+
 _CLIENT: OpenAI | None = None
+_ASYNC_CLIENT: AsyncOpenAI | None = None
 
 
 def _get_client() -> OpenAI:
     global _CLIENT
     if _CLIENT is None:
-        _CLIENT = OpenAI()
+        settings = config.get_settings()
+        _CLIENT = OpenAI(
+            http_client=httpx.Client(
+                http2=_HTTP2, limits=_HTTP_LIMITS, timeout=settings.request_timeout
+            )
+        )
     return _CLIENT
 
 
-def _reasoning_params(settings: config.GPTSettings) -> Dict:
-    model_lower = settings.model.lower()
-    if settings.reasoning_effort and any(
+def _get_async_client() -> AsyncOpenAI:
+    global _ASYNC_CLIENT
+    if _ASYNC_CLIENT is None:
+        settings = config.get_settings()
+        _ASYNC_CLIENT = AsyncOpenAI(
+            http_client=httpx.AsyncClient(
+                http2=_HTTP2, limits=_HTTP_LIMITS, timeout=settings.request_timeout
+            )
+        )
+    return _ASYNC_CLIENT
+
+
+@lru_cache(maxsize=8)
+def _reasoning_params(model: str, reasoning_effort: Optional[str]) -> Dict:
+    model_lower = model.lower()
+    if reasoning_effort and any(
         token in model_lower for token in ("thinking", "reasoning", "gpt-5")
     ):
-        return {"reasoning": {"effort": settings.reasoning_effort}}
+        return {"reasoning": {"effort": reasoning_effort}}
     return {}
 
 
+def _request_kwargs(
+    settings: config.GPTSettings, messages: List[Dict[str, str]], max_tokens: Optional[int]
+) -> Dict:
+    kwargs = {
+        "model": settings.model,
+        "messages": messages,
+        "temperature": settings.temperature,
+        "max_tokens": max_tokens or settings.max_output_tokens,
+        "response_format": {"type": "json_object"},
+    }
+    if max_tokens and max_tokens > settings.max_output_tokens:
+        # Batched requests generate proportionally more output, so stretch the
+        # pooled client's single-order timeout by the same factor.
+        kwargs["timeout"] = settings.request_timeout * max_tokens / settings.max_output_tokens
+    reasoning_body = _reasoning_params(settings.model, settings.reasoning_effort)
+    if reasoning_body:
+        kwargs["extra_body"] = reasoning_body
+    return kwargs
+
+
+def _response_content(response) -> str:
+    content = response.choices[0].message.content
+    if not content or not content.strip():
+        raise ValueError("Empty response from model.")
+    return content.strip()
+
+
 def fetch_completion(messages: List[Dict[str, str]]) -> str:
     """Send the chat request with retries and return the string content."""
 
     settings = config.get_settings()
     client = _get_client()
+    request_kwargs = _request_kwargs(settings, messages, None)
 
     last_error: Exception | None = None
     for attempt in range(1, settings.retry_attempts + 1):
         try:
-            extra_kwargs = {}
-            reasoning_body = _reasoning_params(settings)
-            if reasoning_body:
-                extra_kwargs["extra_body"] = reasoning_body
-
-            response = client.chat.completions.create(
-                model=settings.model,
-                messages=messages,
-                temperature=settings.temperature,
-                max_tokens=settings.max_output_tokens,
-                response_format={"type": "json_object"},
-                **extra_kwargs,
-            )
-            choice = response.choices[0]
-            content = choice.message.content
-            if not content or not content.strip():
-                raise ValueError("Empty response from model.")
-            return content.strip()
+            response = client.chat.completions.create(**request_kwargs)
+            return _response_content(response)
         except Exception as exc:  # noqa: BLE001
             last_error = exc
             if attempt == settings.retry_attempts:
@@ -63,3 +106,28 @@ def fetch_completion(messages: List[Dict[str, str]]) -> str:
 
     assert last_error is not None  # for mypy
     raise last_error
+
+
+async def fetch_completion_async(messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> str:
+    """Async counterpart of :func:`fetch_completion` for concurrent callers.
+
+    ``max_tokens`` raises the output budget for batched requests.
+    """
+
+    settings = config.get_settings()
+    client = _get_async_client()
+    request_kwargs = _request_kwargs(settings, messages, max_tokens)
+
+    last_error: Exception | None = None
+    for attempt in range(1, settings.retry_attempts + 1):
+        try:
+            response = await client.chat.completions.create(**request_kwargs)
+            return _response_content(response)
+        except Exception as exc:  # noqa: BLE001
+            last_error = exc
+            if attempt == settings.retry_attempts:
+                break
+            await asyncio.sleep(settings.retry_backoff_seconds * attempt)
+
+    assert last_error is not None  # for mypy
+    raise last_error
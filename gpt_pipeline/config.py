@@ -4,6 +4,7 @@ from __future__ import annotations
 
 import os
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Optional
 
 
@@ -25,6 +26,7 @@ class GPTSettings:
     retry_backoff_seconds: float = float(_env("GPT_RETRY_BACKOFF", "2.0"))
 
 
+@lru_cache(maxsize=None)
 def get_settings() -> GPTSettings:
     """Return the active GPT configuration."""
 
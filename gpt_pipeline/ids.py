@@ -0,0 +1,25 @@
+"""Row ID selector parsing shared by the parser entry points."""
+
+from __future__ import annotations
+
+from typing import Dict, List
+
+
+def parse_id_selector(selector: str) -> List[int]:
+    """Expand ``"1,5,10-15"`` into unique row IDs, keeping first-seen order."""
+
+    values: Dict[int, None] = {}
+    for part in selector.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start_str, end_str = part.split("-", 1)
+            start = int(start_str, 10)
+            end = int(end_str, 10)
+            if end < start:
+                start, end = end, start
+            values.update(dict.fromkeys(range(start, end + 1)))
+        else:
+            values[int(part, 10)] = None
+    return list(values)
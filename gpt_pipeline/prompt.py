@@ -2,7 +2,7 @@
 
 from __future__ import annotations
 
-from typing import List, Dict
+from typing import List, Dict, Sequence
 
 from .schema import GPTParseRequest
 
@@ -16,6 +16,17 @@ SYSTEM_PROMPT = (
     "Names must be a clean list of individual names. Use the provided default year unless the customer clearly requests a different year."
 )
 
+BATCH_SYSTEM_PROMPT = SYSTEM_PROMPT + (
+    " You may receive several numbered orders at once. Parse each order independently and respond with "
+    '{"results": [{"index": 0, "names": ["Name"], "year": "2025", "requestedProof": false, "needsManualReview": false, "notes": ""}]}, '
+    "containing exactly one entry per order with the order's index."
+)
+
+# Built once and shared so every request starts with a byte-identical prefix,
+# which is what OpenAI's automatic prompt caching keys on.
+SYSTEM_MESSAGE: Dict[str, str] = {"role": "system", "content": SYSTEM_PROMPT}
+BATCH_SYSTEM_MESSAGE: Dict[str, str] = {"role": "system", "content": BATCH_SYSTEM_PROMPT}
+
 
 def build_user_prompt(data: GPTParseRequest) -> str:
     """Create a compact user prompt using the parsed request payload."""
@@ -37,7 +48,15 @@ def build_user_prompt(data: GPTParseRequest) -> str:
 
 def build_messages(data: GPTParseRequest) -> List[Dict[str, str]]:
     """Return the chat message payload for the OpenAI API."""
-    return [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": build_user_prompt(data)},
-    ]
+    return [SYSTEM_MESSAGE, {"role": "user", "content": build_user_prompt(data)}]
+
+
+def build_batch_user_prompt(requests: Sequence[GPTParseRequest]) -> str:
+    """Number each request's prompt so results can be matched back by index."""
+    blocks = [f"Order {index}:\n{build_user_prompt(data)}" for index, data in enumerate(requests)]
+    return "\n\n".join(blocks)
+
+
+def build_batch_messages(requests: Sequence[GPTParseRequest]) -> List[Dict[str, str]]:
+    """Return the chat message payload for parsing several requests in one call."""
+    return [BATCH_SYSTEM_MESSAGE, {"role": "user", "content": build_batch_user_prompt(requests)}]
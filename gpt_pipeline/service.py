@@ -5,15 +5,29 @@ from __future__ import annotations
 import json
 import logging
 import re
-from typing import List, Optional
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
-from . import client, prompt
+from jsonutil import json_dumps, json_loads
+
+from . import client, config, prompt
+from .cache import ResponseCache
 from .schema import GPTParseRequest, OrderRow, ParseResult
 
+_YEAR_RE = re.compile(r"(?:19|20)\d{2}")
+_PERSONALIZATION_RE = re.compile(r"personali[sz]ation|list of names")
+_OPTION_KEYS = ("options", "extendedOptions")
+_PERSONALIZATION_KEYS = ("personalization", "names", "customization")
+_BUYER_NOTE_KEYS = ("buyerNotes", "customerNotes", "note_from_buyer", "noteFromBuyer")
+
 
+# Parsed payloads are cached by their raw text so re-running a row (e.g. the
+# per-row retry after a failed batch) does not decode the same blob again.
+# Callers must treat the returned dict as read-only.
+@lru_cache(maxsize=4096)
 def _safe_json_loads(payload: str) -> dict:
     try:
-        return json.loads(payload)
+        return json_loads(payload)
     except json.JSONDecodeError as exc:
         raise ValueError("raw_json column does not contain valid JSON data") from exc
 
@@ -24,9 +38,10 @@ def _extract_personalization(item: dict) -> str:
     def ensure_list(value):
         if isinstance(value, list):
             return value
-        if isinstance(value, str):
+        # Only a JSON array can yield options; skip the decode attempt otherwise.
+        if isinstance(value, str) and value.lstrip().startswith("["):
             try:
-                parsed = json.loads(value)
+                parsed = json_loads(value)
                 if isinstance(parsed, list):
                     return parsed
             except (json.JSONDecodeError, TypeError, ValueError):
@@ -39,13 +54,12 @@ def _extract_personalization(item: dict) -> str:
             value = str(option.get("value") or "").strip()
             if not value:
                 continue
-            lower_name = name.lower()
-            if any(keyword in lower_name for keyword in ("personalization", "personalisation", "list of names")):
+            if _PERSONALIZATION_RE.search(name.lower()):
                 return value
         return None
 
     # Check top-level options first
-    for options_key in ("options", "extendedOptions"):
+    for options_key in _OPTION_KEYS:
         options = ensure_list(item.get(options_key) or [])
         if not isinstance(options, list):
             continue
@@ -55,13 +69,13 @@ def _extract_personalization(item: dict) -> str:
 
     json_data = item.get("jsonData") or item.get("json_data")
     if isinstance(json_data, dict):
-        for options_key in ("options", "extendedOptions"):
+        for options_key in _OPTION_KEYS:
             options = ensure_list(json_data.get(options_key) or [])
             personalization_value = find_personalization(options)
             if personalization_value:
                 return personalization_value
 
-        for key in ("personalization", "names", "customization"):
+        for key in _PERSONALIZATION_KEYS:
             value = json_data.get(key)
             if isinstance(value, str) and value.strip():
                 return value.strip()
@@ -75,7 +89,7 @@ def _extract_personalization(item: dict) -> str:
 
 
 def _extract_buyer_note(item: dict) -> Optional[str]:
-    for key in ("buyerNotes", "customerNotes", "note_from_buyer", "noteFromBuyer"):
+    for key in _BUYER_NOTE_KEYS:
         value = item.get(key)
         if isinstance(value, str) and value.strip():
             return value.strip()
@@ -95,22 +109,19 @@ def _parse_names(value) -> List[str]:
     if isinstance(value, list):
         return [str(v).strip() for v in value if str(v).strip()]
     if isinstance(value, str):
-        try:
-            parsed = json.loads(value)
-            if isinstance(parsed, list):
-                return [str(v).strip() for v in parsed if str(v).strip()]
-        except json.JSONDecodeError:
-            pass
+        # Most model answers are plain comma-separated text; only try JSON for arrays.
+        if value.lstrip().startswith("["):
+            try:
+                parsed = json_loads(value)
+                if isinstance(parsed, list):
+                    return [str(v).strip() for v in parsed if str(v).strip()]
+            except json.JSONDecodeError:
+                pass
         return [part.strip() for part in value.split(",") if part.strip()]
     return []
 
 
-def _normalise_model_response(content: str, default_year: str = "2025") -> ParseResult:
-    try:
-        data = json.loads(content)
-    except json.JSONDecodeError as exc:
-        raise ValueError(f"Model response is not valid JSON: {content}") from exc
-
+def _normalise_model_payload(data: dict, content: str, default_year: str = "2025") -> ParseResult:
     names = _parse_names(data.get("names"))
     requested_proof = bool(data.get("requestedProof") or data.get("requested_proof"))
     needs_manual = bool(
@@ -123,10 +134,10 @@ def _normalise_model_response(content: str, default_year: str = "2025") -> Parse
     if isinstance(year_value, int):
         year_value = str(year_value)
     if not isinstance(year_value, str) or not year_value.strip():
-        year_value = "2025"
+        year_value = default_year
     else:
-        match = re.search(r"(20\\d{2}|19\\d{2})", year_value)
-        year_value = match.group(1) if match else "2025"
+        match = _YEAR_RE.search(year_value)
+        year_value = match.group(0) if match else default_year
 
     return ParseResult(
         names=names,
@@ -138,6 +149,44 @@ def _normalise_model_response(content: str, default_year: str = "2025") -> Parse
     )
 
 
+def _normalise_model_response(content: str, default_year: str = "2025") -> ParseResult:
+    try:
+        data = json_loads(content)
+    except json.JSONDecodeError as exc:
+        raise ValueError(f"Model response is not valid JSON: {content}") from exc
+
+    return _normalise_model_payload(data, content, default_year)
+
+
+def _normalise_batch_response(content: str, requests: Sequence[GPTParseRequest]) -> List[ParseResult]:
+    try:
+        data = json_loads(content)
+    except json.JSONDecodeError as exc:
+        raise ValueError(f"Model response is not valid JSON: {content}") from exc
+
+    entries = data.get("results") if isinstance(data, dict) else None
+    if not isinstance(entries, list):
+        raise ValueError(f"Model response has no results list: {content}")
+
+    by_index = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            by_index[int(entry.get("index"))] = entry
+        except (TypeError, ValueError):
+            continue
+
+    results: List[ParseResult] = []
+    for index, request in enumerate(requests):
+        entry = by_index.get(index)
+        if entry is None:
+            raise ValueError(f"Model response is missing a result for order index {index}")
+        raw = json_dumps(entry)
+        results.append(_normalise_model_payload(entry, raw, request.default_year))
+    return results
+
+
 def build_request(row: OrderRow) -> GPTParseRequest:
     item_payload = _safe_json_loads(row.raw_json)
 
@@ -154,14 +203,147 @@ def build_request(row: OrderRow) -> GPTParseRequest:
         default_year=row.year or "2025",
     )
 
-def parse_order(row: OrderRow, request: GPTParseRequest | None = None) -> ParseResult:
+
+def _build_requests(rows: Sequence[OrderRow]) -> List[Union[GPTParseRequest, Exception]]:
+    """Build each row's request; a row that cannot be built yields its error instead."""
+
+    requests: List[Union[GPTParseRequest, Exception]] = []
+    for row in rows:
+        try:
+            requests.append(build_request(row))
+        except Exception as exc:  # noqa: BLE001
+            requests.append(exc)
+    return requests
+
+
+def _is_empty_request(request: GPTParseRequest) -> bool:
+    return not request.personalization_text.strip() and not (request.buyer_note or "").strip()
+
+
+def _empty_result(request: GPTParseRequest) -> ParseResult:
+    # Nothing for the model to read; flag the row for a human instead of paying for a call.
+    return ParseResult(
+        names=[],
+        requested_proof=False,
+        needs_manual_review=True,
+        year=request.default_year,
+        notes="empty input",
+        raw_response="",
+    )
+
+
+def _prepare_messages(
+    request: GPTParseRequest, cache: ResponseCache | None
+) -> Tuple[List[Dict[str, str]], ParseResult | None]:
+    """Return the request's prompt, plus a result when it needs no API call.
+
+    Empty requests resolve to a manual-review result and cached prompts to
+    their stored response; anything else comes back with ``None``.
+    """
+
+    if _is_empty_request(request):
+        return [], _empty_result(request)
+    messages = prompt.build_messages(request)
+    if cache is not None:
+        cached = cache.get(messages)
+        if cached is not None:
+            return messages, _normalise_model_response(cached, request.default_year)
+    return messages, None
+
+
+def _store_result(
+    cache: ResponseCache | None,
+    request: GPTParseRequest,
+    messages: List[Dict[str, str]],
+    response_text: str,
+) -> ParseResult:
+    result = _normalise_model_response(response_text, request.default_year)
+    if cache is not None:
+        cache.put(messages, response_text)
+    return result
+
+
+def _store_batch(
+    cache: ResponseCache | None,
+    messages: Sequence[List[Dict[str, str]]],
+    results: Sequence[ParseResult],
+) -> None:
+    # Batch entries are cached under each order's single-order prompt so that
+    # duplicates hit regardless of which batch they land in.
+    if cache is None:
+        return
+    for order_messages, result in zip(messages, results):
+        cache.put(order_messages, result.raw_response)
+
+
+def parse_order(
+    row: OrderRow, request: GPTParseRequest | None = None, cache: ResponseCache | None = None
+) -> ParseResult:
     """Create the GPT request for a DB row and return the parsed response."""
 
     if request is None:
         request = build_request(row)
+    messages, result = _prepare_messages(request, cache)
+    if result is not None:
+        return result
 
-    messages = prompt.build_messages(request)
     logging.debug("Sending GPT request for order %s item %s", row.order_number, row.item_id)
+    return _store_result(cache, request, messages, client.fetch_completion(messages))
 
-    response_text = client.fetch_completion(messages)
-    return _normalise_model_response(response_text, request.default_year)
+
+async def parse_order_async(
+    row: OrderRow, request: GPTParseRequest | None = None, cache: ResponseCache | None = None
+) -> ParseResult:
+    """Async counterpart of :func:`parse_order`."""
+
+    if request is None:
+        request = build_request(row)
+    messages, result = _prepare_messages(request, cache)
+    if result is not None:
+        return result
+
+    logging.debug("Sending GPT request for order %s item %s", row.order_number, row.item_id)
+    return _store_result(cache, request, messages, await client.fetch_completion_async(messages))
+
+
+async def parse_orders_batch_async(
+    rows: Sequence[OrderRow], cache: ResponseCache | None = None
+) -> List[Union[ParseResult, Exception]]:
+    """Parse several rows with a single GPT call; results follow the order of ``rows``.
+
+    A row whose request cannot be built gets its exception as its result, so one
+    bad row does not cost the rest of the batch its shared call.
+    """
+
+    requests = _build_requests(rows)
+    results: List[Union[ParseResult, Exception, None]] = []
+    messages: List[List[Dict[str, str]]] = []
+    for request in requests:
+        if isinstance(request, Exception):
+            order_messages, result = [], request
+        else:
+            order_messages, result = _prepare_messages(request, cache)
+        messages.append(order_messages)
+        results.append(result)
+    pending = [index for index, result in enumerate(results) if result is None]
+
+    if len(pending) == 1:
+        index = pending[0]
+        results[index] = await parse_order_async(rows[index], request=requests[index], cache=cache)
+    elif pending:
+        batch = [requests[index] for index in pending]
+        logging.debug(
+            "Sending batched GPT request for %d items (orders %s)",
+            len(batch),
+            ", ".join(rows[index].order_number for index in pending),
+        )
+
+        max_tokens = config.get_settings().max_output_tokens * len(batch)
+        response_text = await client.fetch_completion_async(
+            prompt.build_batch_messages(batch), max_tokens=max_tokens
+        )
+        batch_results = _normalise_batch_response(response_text, batch)
+        _store_batch(cache, [messages[index] for index in pending], batch_results)
+        for index, result in zip(pending, batch_results):
+            results[index] = result
+    return results
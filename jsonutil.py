@@ -0,0 +1,28 @@
+"""JSON helpers shared by the scripts and the GPT pipeline; orjson is used when installed."""
+
+from __future__ import annotations
+
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # orjson is an optional speedup; fall back to the stdlib.
+    orjson = None
+
+
+def json_dumps(value: Any) -> str:
+    """Encode compact, non-ASCII-escaped JSON text."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode("utf-8")
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def json_loads(value: str | bytes) -> Any:
+    """Decode JSON text; decode errors subclass ``json.JSONDecodeError`` either way."""
+    if orjson is not None:
+        return orjson.loads(value)
+    return json.loads(value)
@@ -3,47 +3,47 @@
 from __future__ import annotations
 
 import argparse
-import json
+import asyncio
 import sqlite3
 import sys
+from itertools import islice
 from pathlib import Path
-from typing import Iterable, List, Optional, Sequence
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
 CURRENT_DIR = Path(__file__).resolve().parent
 PROJECT_ROOT = CURRENT_DIR.parent
 if str(PROJECT_ROOT) not in sys.path:
     sys.path.insert(0, str(PROJECT_ROOT))
 
-from gpt_pipeline import OrderRow  # noqa: E402
-from gpt_pipeline.service import build_request, parse_order  # noqa: E402
-
-
-def parse_id_selector(selector: str) -> List[int]:
-    values: List[int] = []
-    for part in selector.split(","):
-        part = part.strip()
-        if not part:
-            continue
-        if "-" in part:
-            start_str, end_str = part.split("-", 1)
-            start = int(start_str, 10)
-            end = int(end_str, 10)
-            if end < start:
-                start, end = end, start
-            values.extend(range(start, end + 1))
-        else:
-            values.append(int(part, 10))
-    return sorted(set(values))
+import setup_order_db  # noqa: E402
+from jsonutil import json_dumps  # noqa: E402
+from gpt_pipeline import OrderRow, ParseResult  # noqa: E402
+from gpt_pipeline.cache import ResponseCache  # noqa: E402
+from gpt_pipeline.ids import parse_id_selector  # noqa: E402
+from gpt_pipeline.service import parse_order_async, parse_orders_batch_async  # noqa: E402
+
+FLUSH_ROWS = 50
+FLUSH_SECONDS = 5.0
+
+UPDATE_SQL = """
+    UPDATE order_items
+    SET names = ?,
+        year = ?,
+        requested_proof = ?,
+        needs_manual_review = ?,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = ?
+"""
 
 
-def fetch_rows(
+def iter_rows(
     conn: sqlite3.Connection,
     product: str,
     limit: int,
     ids: Sequence[int],
     force: bool,
     include_shipped: bool,
-) -> List[OrderRow]:
+) -> Iterator[OrderRow]:
     clauses = ["product = ?"]
     params: List[object] = [product]
 
@@ -52,7 +52,8 @@ def fetch_rows(
         clauses.append(f"id IN ({placeholders})")
         params.extend(ids)
     elif not force:
-        clauses.append("(names IS NULL OR TRIM(names) = '')")
+        # names is only ever written as a JSON array, so no TRIM() is needed.
+        clauses.append("(names IS NULL OR names = '')")
 
     if not include_shipped:
         clauses.append("shipped = 0")
@@ -69,57 +70,184 @@ def fetch_rows(
     """
     params.append(limit)
 
-    cursor = conn.cursor()
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
-
-    order_rows: List[OrderRow] = []
-    for row in rows:
-        order_rows.append(
-            OrderRow(
-                id=row["id"],
-                order_number=row["order_number"],
-                item_id=row["item_id"],
-                raw_json=row["raw_json"],
-                product=row["product"],
-                quantity=int(row["quantity"] or 0),
-                options=row["options"],
-                names=row["names"],
-                buyer_note=row["buyer_note"],
-                year=row["year"],
-                requested_proof=row["requested_proof"],
-                needs_manual_review=row["needs_manual_review"],
-            )
+    for row in conn.execute(query, params):
+        yield OrderRow(
+            id=row["id"],
+            order_number=row["order_number"],
+            item_id=row["item_id"],
+            raw_json=row["raw_json"],
+            product=row["product"],
+            quantity=int(row["quantity"] or 0),
+            options=row["options"],
+            names=row["names"],
+            buyer_note=row["buyer_note"],
+            year=row["year"],
+            requested_proof=row["requested_proof"],
+            needs_manual_review=row["needs_manual_review"],
         )
-    return order_rows
 
 
-def update_row(
-    cursor: sqlite3.Cursor,
+def build_update(
     row_id: int,
     names: List[str],
     year: str,
     requested_proof: bool,
     needs_manual_review: bool,
+) -> Tuple[str, str, int, int, int]:
+    return (
+        json_dumps(names),
+        year,
+        int(requested_proof),
+        int(needs_manual_review),
+        row_id,
+    )
+
+
+def save_updates(
+    conn: sqlite3.Connection,
+    updates: List[Tuple[str, str, int, int, int]],
+    cache: Optional[ResponseCache] = None,
 ) -> None:
-    cursor.execute(
-        """
-        UPDATE order_items
-        SET names = ?,
-            year = ?,
-            requested_proof = ?,
-            needs_manual_review = ?,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE id = ?
-        """,
-        (
-            json.dumps(names, ensure_ascii=False),
-            year,
-            int(requested_proof),
-            int(needs_manual_review),
-            row_id,
-        ),
+    # The connection context manager commits the batch, or rolls it back on error.
+    # Buffered cache entries ride along in the same transaction.
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(UPDATE_SQL, updates)
+        if cache is not None:
+            cache.flush()
+
+
+async def parse_rows(
+    batch: List[OrderRow], cache: Optional[ResponseCache] = None
+) -> List[Tuple[OrderRow, Union[ParseResult, Exception]]]:
+    """Parse a batch in one GPT call, retrying rows one by one if the batch fails."""
+    try:
+        return list(zip(batch, await parse_orders_batch_async(batch, cache=cache)))
+    except Exception as exc:  # noqa: BLE001
+        if len(batch) == 1:
+            return [(batch[0], exc)]
+        print(f"[WARN] Batch of {len(batch)} row(s) failed ({exc}); retrying rows individually.")
+
+    outcomes: List[Tuple[OrderRow, Union[ParseResult, Exception]]] = []
+    for row in batch:
+        try:
+            outcomes.append((row, await parse_order_async(row, cache=cache)))
+        except Exception as exc:  # noqa: BLE001
+            outcomes.append((row, exc))
+    return outcomes
+
+
+async def read_batches(
+    rows: Iterable[OrderRow], batch_size: int, batches: asyncio.Queue, workers: int
+) -> None:
+    """Feed row batches to the workers as they are read, then one stop marker per worker."""
+    row_iter = iter(rows)
+    while batch := list(islice(row_iter, max(batch_size, 1))):
+        await batches.put(batch)
+    for _ in range(workers):
+        await batches.put(None)
+
+
+async def parse_worker(
+    batches: asyncio.Queue, outcomes: asyncio.Queue, cache: Optional[ResponseCache]
+) -> None:
+    while (batch := await batches.get()) is not None:
+        for outcome in await parse_rows(batch, cache):
+            await outcomes.put(outcome)
+    await outcomes.put(None)
+
+
+async def write_outcomes(
+    conn: sqlite3.Connection,
+    outcomes: asyncio.Queue,
+    workers: int,
+    cache: Optional[ResponseCache],
+    verbose: bool,
+    dry_run: bool,
+) -> Tuple[int, int]:
+    """Save results every FLUSH_ROWS rows or FLUSH_SECONDS while parsing continues.
+
+    Returns the number of processed rows and the number of failures.
+    """
+    loop = asyncio.get_running_loop()
+    processed = 0
+    failures = 0
+    updates: List[Tuple[str, str, int, int, int]] = []
+    # Report lines are collected and written once per flush instead of a print per line.
+    report: List[str] = []
+    running = workers
+    last_flush = loop.time()
+
+    while running:
+        timeout = max(FLUSH_SECONDS - (loop.time() - last_flush), 0)
+        try:
+            outcome = await asyncio.wait_for(outcomes.get(), timeout)
+        except asyncio.TimeoutError:
+            outcome = None
+        else:
+            if outcome is None:
+                running -= 1
+
+        if outcome is not None:
+            row, result = outcome
+            if isinstance(result, Exception):
+                failures += 1
+                report.append(
+                    f"[ERROR] Failed to parse row {row.id} (order {row.order_number}, item {row.item_id}): {result}"
+                )
+            else:
+                if verbose:
+                    report.append("=" * 80)
+                    report.append(f"Row {row.id} | Order {row.order_number} | Item {row.item_id}")
+                    report.append(f"Names: {', '.join(result.names) if result.names else '<none>'}")
+                    report.append(f"Year: {result.year}")
+                    report.append(f"Requested proof: {result.requested_proof}")
+                    report.append(f"Manual review: {result.needs_manual_review}")
+                    if result.notes:
+                        report.append(f"Notes: {result.notes}")
+
+                updates.append(
+                    build_update(
+                        row_id=row.id,
+                        names=result.names,
+                        year=result.year,
+                        requested_proof=result.requested_proof,
+                        needs_manual_review=result.needs_manual_review,
+                    )
+                )
+                processed += 1
+
+        if len(updates) >= FLUSH_ROWS or loop.time() - last_flush >= FLUSH_SECONDS or not running:
+            if report:
+                sys.stdout.write("\n".join(report) + "\n")
+                report.clear()
+            if updates and not dry_run:
+                save_updates(conn, updates, cache)
+            updates.clear()
+            last_flush = loop.time()
+
+    return processed, failures
+
+
+async def run_pipeline(
+    rows: Iterable[OrderRow],
+    conn: sqlite3.Connection,
+    batch_size: int,
+    concurrency: int,
+    cache: Optional[ResponseCache],
+    verbose: bool,
+    dry_run: bool,
+) -> Tuple[int, int]:
+    """Overlap reading rows, GPT calls and result writes through bounded queues."""
+    workers = max(concurrency, 1)
+    batches: asyncio.Queue = asyncio.Queue(maxsize=workers * 2)
+    outcomes: asyncio.Queue = asyncio.Queue(maxsize=FLUSH_ROWS * 2)
+    results = await asyncio.gather(
+        read_batches(rows, batch_size, batches, workers),
+        *(parse_worker(batches, outcomes, cache) for _ in range(workers)),
+        write_outcomes(conn, outcomes, workers, cache, verbose, dry_run),
     )
+    return results[-1]
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -137,6 +265,18 @@ def build_parser() -> argparse.ArgumentParser:
         help="Only process items for this product (default: 3d-Christmas-Tree-Ornament).",
     )
     parser.add_argument("--limit", type=int, default=50, help="Maximum number of rows to process.")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=10,
+        help="Number of rows parsed per GPT request (default: 10; 1 sends one request per row).",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of GPT requests in flight at once (default: 8).",
+    )
     parser.add_argument(
         "--ids",
         help="Comma-separated list or ranges of row IDs to process (e.g., 1,5,10-15). Overrides automatic selection.",
@@ -151,6 +291,11 @@ def build_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="Include rows that already have shipped=1 (default: skip shipped rows).",
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always call the model instead of reusing cached responses for identical prompts.",
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
@@ -168,72 +313,50 @@ def main(argv: Optional[Iterable[str]] = None) -> int:
     args = build_parser().parse_args(argv)
 
     conn = sqlite3.connect(args.db_path)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    setup_order_db.configure_connection(conn)
+    setup_order_db.ensure_schema(conn)
+    # Rows are streamed from their own connection so batch commits on ``conn``
+    # never interleave with the open SELECT.
+    read_conn = sqlite3.connect(args.db_path)
+    setup_order_db.configure_connection(read_conn)
+    read_conn.row_factory = sqlite3.Row
 
     ids = parse_id_selector(args.ids) if args.ids else []
+    # Dry runs may reuse cached responses but never add to the cache.
+    cache = None if args.no_cache else ResponseCache(conn, read_only=args.dry_run)
 
     try:
-        rows = fetch_rows(
-            conn=conn,
+        rows = iter_rows(
+            conn=read_conn,
             product=args.product,
             limit=args.limit,
             ids=ids,
             force=args.force,
             include_shipped=args.include_shipped,
         )
-        if not rows:
+        processed, failures = asyncio.run(
+            run_pipeline(
+                rows,
+                conn,
+                batch_size=args.batch_size,
+                concurrency=args.concurrency,
+                cache=cache,
+                verbose=args.verbose,
+                dry_run=args.dry_run,
+            )
+        )
+        if not processed and not failures:
             print("No matching rows to process.")
             return 0
 
-        processed = 0
-        updated = 0
-        failures = 0
-
-        for row in rows:
-            request = build_request(row)
-            try:
-                result = parse_order(row, request=request)
-            except Exception as exc:  # noqa: BLE001
-                failures += 1
-                print(
-                    f"[ERROR] Failed to parse row {row.id} (order {row.order_number}, item {row.item_id}): {exc}"
-                )
-                continue
-
-            if args.verbose:
-                print("=" * 80)
-                print(f"Row {row.id} | Order {row.order_number} | Item {row.item_id}")
-                print(f"Names: {', '.join(result.names) if result.names else '<none>'}")
-                print(f"Year: {result.year}")
-                print(f"Requested proof: {result.requested_proof}")
-                print(f"Manual review: {result.needs_manual_review}")
-                if result.notes:
-                    print(f"Notes: {result.notes}")
-
-            update_row(
-                cursor=cursor,
-                row_id=row.id,
-                names=result.names,
-                year=result.year,
-                requested_proof=result.requested_proof,
-                needs_manual_review=result.needs_manual_review,
-            )
-            updated += 1
-            processed += 1
-
-        if updated and not args.dry_run:
-            conn.commit()
-        elif args.dry_run:
-            conn.rollback()
-
         print(
-            f"Processed {processed} row(s). Updated {updated}. Failures {failures}. "
+            f"Processed {processed} row(s). Updated {processed}. Failures {failures}. "
             f"{'Changes rolled back (dry run).' if args.dry_run else ''}"
         )
 
         return 0
     finally:
+        read_conn.close()
         conn.close()
 
 
@@ -43,20 +43,22 @@ function saveAsPDF(doc, outPath, artboards) {
   doc.saveAs(f, o);
 }
 
-function main() {
-    // read json file
-    var nameFile=File('C:/Users/Egor/Documents/3dTreeAuto/data/tree_data.json');
-    nameFile.open("r");
-    var jsonData=nameFile.read();
-    nameFile.close();
-    var data=eval('(' + jsonData + ')')
-
-    var layerName=data['layerName']
-    var names=data['names']
-    var filename=data['filename']
+function makeTree(job) {
+    var layerName=job['layerName']
+    var names=job['names']
+    var filename=job['filename']
 
 
     var doc = app.open(File(TEMPLATE_PATH));
+    // Only ever close the template opened here, never the user's active document.
+    try {
+        fillTree(doc, layerName, names, filename);
+    } finally {
+        doc.close(SaveOptions.DONOTSAVECHANGES);
+    }
+}
+
+function fillTree(doc, layerName, names, filename) {
     try {
         var treeLayer = doc.layers.getByName(layerName);
     } catch (e) {
@@ -93,7 +95,26 @@ function main() {
 
     var OUT = SAVE_DIR + filename ;
     saveAsPDF(doc, OUT); 
-    doc.close()
+}
+
+function main() {
+    // read json file
+    var nameFile=File('C:/Users/Egor/Documents/3dTreeAuto/data/tree_data.json');
+    nameFile.open("r");
+    var jsonData=nameFile.read();
+    nameFile.close();
+    var data=eval('(' + jsonData + ')')
+
+    // generate_files.py writes {"jobs": [...]}; a bare job object is still accepted.
+    var jobs = data['jobs'] || [data];
+    for (var j=0;j<jobs.length;j++) {
+        try {
+            makeTree(jobs[j]);
+        } catch (e) {
+            // A failed job leaves no PDF behind; generate_files.py reports it.
+            // makeTree has already closed its template, so carry on with the next job.
+        }
+    }
 }
 
 main();
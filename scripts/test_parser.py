@@ -16,28 +16,11 @@ if str(PROJECT_ROOT) not in sys.path:
     sys.path.insert(0, str(PROJECT_ROOT))
 
 from gpt_pipeline import OrderRow
+from gpt_pipeline.ids import parse_id_selector
 from gpt_pipeline.prompt import build_user_prompt
 from gpt_pipeline.service import build_request, parse_order
 
 
-def parse_id_selector(selector: str) -> List[int]:
-    values: List[int] = []
-    for part in selector.split(","):
-        part = part.strip()
-        if not part:
-            continue
-        if "-" in part:
-            start_str, end_str = part.split("-", 1)
-            start = int(start_str, 10)
-            end = int(end_str, 10)
-            if end < start:
-                start, end = end, start
-            values.extend(range(start, end + 1))
-        else:
-            values.append(int(part, 10))
-    return sorted(set(values))
-
-
 def fetch_rows(
     db_path: Path,
     ids: Sequence[int],
@@ -119,38 +102,38 @@ def run(args: argparse.Namespace) -> None:
     updates_made = 0
 
     for row in rows:
-        print("=" * 80)
-        print(f"Row #{row.id} | Order {row.order_number} | Item {row.item_id}")
+        # Each block is written in one go: once before the GPT call, once after.
+        lines = ["=" * 80, f"Row #{row.id} | Order {row.order_number} | Item {row.item_id}"]
         existing_names = parse_existing_names(row.names)
         if existing_names:
-            print(f"Existing names: {', '.join(existing_names)}")
+            lines.append(f"Existing names: {', '.join(existing_names)}")
         if row.year:
-            print(f"Existing year: {row.year}")
-        print(f"Existing requested proof: {bool(row.requested_proof)}")
-        print(f"Existing manual review: {bool(row.needs_manual_review)}")
+            lines.append(f"Existing year: {row.year}")
+        lines.append(f"Existing requested proof: {bool(row.requested_proof)}")
+        lines.append(f"Existing manual review: {bool(row.needs_manual_review)}")
 
         request = build_request(row)
         prompt_text = build_user_prompt(request)
-        print("User prompt:")
-        print(prompt_text)
-        print()
+        lines.extend(["User prompt:", prompt_text, ""])
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
 
         try:
             result = parse_order(row, request=request)
         except Exception as exc:  # noqa: BLE001
-            print(f"Error while parsing: {exc}")
-            print()
+            sys.stdout.write(f"Error while parsing: {exc}\n\n")
             continue
 
-        print(f"GPT names: {', '.join(result.names) if result.names else '<none>'}")
-        print(f"Requested proof: {result.requested_proof}")
-        print(f"Needs manual review: {result.needs_manual_review}")
-        print(f"Year: {result.year}")
+        lines = [
+            f"GPT names: {', '.join(result.names) if result.names else '<none>'}",
+            f"Requested proof: {result.requested_proof}",
+            f"Needs manual review: {result.needs_manual_review}",
+            f"Year: {result.year}",
+        ]
         if result.notes:
-            print(f"Notes: {result.notes}")
+            lines.append(f"Notes: {result.notes}")
         if args.show_raw:
-            print("Raw response:")
-            print(result.raw_response)
+            lines.extend(["Raw response:", result.raw_response])
 
         should_update = False
         set_clause = []
@@ -188,9 +171,9 @@ def run(args: argparse.Namespace) -> None:
                 values,
             )
             updates_made += 1
-            print("Saved parsed data to database.")
+            lines.append("Saved parsed data to database.")
 
-        print()
+        sys.stdout.write("\n".join(lines) + "\n\n")
 
     if updates_made:
         updater.commit()
@@ -2,9 +2,30 @@ import re
 import argparse
 import json
 import sqlite3
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterable, Iterator, Sequence, Tuple
 
+from jsonutil import json_dumps, json_loads
+
+
+# Bump whenever CREATE_TABLE_SQL, CREATE_CACHE_TABLE_SQL, ADD_COLUMNS or
+# CREATE_INDEXES change so that existing databases re-run the schema checks once.
+SCHEMA_VERSION = 3
+# Databases older than this may hold rows downloaded without their option year;
+# the first initialise_database after the upgrade backfills every row once, and
+# only that backfill's transaction moves them past this version.
+FULL_BACKFILL_VERSION = 3
+
+YEAR_RE = re.compile(r"(20\d{2}|19\d{2})")
+# Matches the opening brace of a JSON object without copying the payload.
+JSON_OBJECT_START_RE = re.compile(r"\s*\{")
+BACKFILL_BATCH_SIZE = 5000
+YEAR_KEYS = ("year", "Year")
+OPTION_KEYS = ("options", "extendedOptions")
+ITEM_NOTE_KEYS = ("buyerNotes", "customerNotes", "note_from_buyer", "noteFromBuyer")
+JSON_DATA_NOTE_KEYS = ("customerNotes", "note_from_buyer", "noteFromBuyer")
 
 CREATE_TABLE_SQL = """
 CREATE TABLE IF NOT EXISTS order_items (
@@ -34,6 +55,15 @@ CREATE TABLE IF NOT EXISTS order_items (
 );
 """
 
+# Model responses keyed by a hash of the prompt (see gpt_pipeline.cache).
+CREATE_CACHE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS gpt_cache (
+    prompt_hash TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+) WITHOUT ROWID
+"""
+
 ADD_COLUMNS = {
     "names": "ALTER TABLE order_items ADD COLUMN names TEXT",
     "shipped": "ALTER TABLE order_items ADD COLUMN shipped INTEGER NOT NULL DEFAULT 0",
@@ -55,6 +85,13 @@ ADD_COLUMNS = {
     "updated_at": "ALTER TABLE order_items ADD COLUMN updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
 }
 
+# Rows that still lack derived metadata. download.py fills these columns
+# (including the year) on insert, so only legacy rows (or ones the backfill
+# could not complete) match.
+BACKFILL_TODO_WHERE = (
+    "product IS NULL OR product = '' OR options IS NULL OR options = '' OR year IS NULL OR year = ''"
+)
+
 CREATE_INDEXES = [
     "CREATE INDEX IF NOT EXISTS idx_order_items_order_number ON order_items(order_number)",
     "CREATE INDEX IF NOT EXISTS idx_order_items_item_id ON order_items(item_id)",
@@ -64,12 +101,59 @@ CREATE_INDEXES = [
     "CREATE INDEX IF NOT EXISTS idx_order_items_is_generated ON order_items(is_generated)",
     "CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items(order_id)",
     "CREATE INDEX IF NOT EXISTS idx_order_items_tags_applied ON order_items(tags_applied)",
+    "CREATE INDEX IF NOT EXISTS idx_order_items_product_shipped_id ON order_items(product, shipped, id)",
+    "CREATE INDEX IF NOT EXISTS idx_order_items_tag_scan ON order_items(tags_applied, product, order_id)",
+    f"CREATE INDEX IF NOT EXISTS idx_order_items_backfill_todo ON order_items(order_number) WHERE {BACKFILL_TODO_WHERE}",
+    """
+    CREATE INDEX IF NOT EXISTS idx_order_items_ready_to_generate ON order_items(product, id)
+    WHERE names IS NOT NULL AND TRIM(names) != ''
+      AND requested_proof = 0 AND needs_manual_review = 0
+      AND file_found = 0 AND is_generated = 0
+    """,
 ]
 
 
+BACKFILL_UPDATE_SQL = """
+UPDATE order_items
+SET file_found = ?, product = ?, quantity = ?, options = ?, custom_field1 = ?, buyer_note = ?, year = ?, requested_proof = ?, needs_manual_review = ?, updated_at = CURRENT_TIMESTAMP
+WHERE order_number = ? AND item_id = ?
+"""
+
+# SQLite 3.33+ can apply a whole chunk in one statement by joining against a
+# VALUES list; each row is then a single index probe instead of a full UPDATE.
+BACKFILL_UPDATE_FROM_VALUES_SQL = """
+WITH v(file_found, product, quantity, options, custom_field1, buyer_note, year, requested_proof, needs_manual_review, order_number, item_id) AS (
+    VALUES {rows}
+)
+UPDATE order_items
+SET file_found = v.file_found, product = v.product, quantity = v.quantity, options = v.options,
+    custom_field1 = v.custom_field1, buyer_note = v.buyer_note, year = v.year,
+    requested_proof = v.requested_proof, needs_manual_review = v.needs_manual_review,
+    updated_at = CURRENT_TIMESTAMP
+FROM v
+WHERE order_items.order_number = v.order_number AND order_items.item_id = v.item_id
+"""
+BACKFILL_UPDATE_COLUMNS = 11
+
+
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA busy_timeout=5000",
+]
+
+
+def configure_connection(conn: sqlite3.Connection) -> None:
+    for statement in CONNECTION_PRAGMAS:
+        conn.execute(statement)
+
+
 def ensure_table(conn: sqlite3.Connection) -> None:
     cur = conn.cursor()
     cur.execute(CREATE_TABLE_SQL)
+    cur.execute(CREATE_CACHE_TABLE_SQL)
     conn.commit()
 
 
@@ -92,7 +176,39 @@ def ensure_indexes(conn: sqlite3.Connection) -> None:
     conn.commit()
 
 
+def ensure_schema(conn: sqlite3.Connection) -> int:
+    """Bring the schema up to SCHEMA_VERSION and return the version found.
+
+    A database still owed the full backfill keeps its old version here, so
+    callers other than initialise_database cannot skip the repair.
+    """
+    # The version lives in the database header (PRAGMA user_version), so a warm
+    # start costs one pragma read instead of the table_info and index checks.
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+    if version == SCHEMA_VERSION:
+        return version
+    ensure_table(conn)
+    ensure_columns(conn)
+    ensure_indexes(conn)
+    if version >= FULL_BACKFILL_VERSION:
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    return version
+
+
+def refresh_statistics(conn: sqlite3.Connection) -> None:
+    # Sampled ANALYZE keeps planner stats current (so partial indexes get picked)
+    # without a full scan of every index on each start.
+    conn.execute("PRAGMA analysis_limit=1000")
+    conn.execute("ANALYZE")
+    conn.commit()
+
+
 def normalise_quantity(value) -> int:
+    # Fast paths for the usual JSON integer / digit-string quantities.
+    if type(value) is int:
+        return value
+    if isinstance(value, str) and value.isdecimal():
+        return int(value)
     if value is None:
         return 0
     try:
@@ -104,8 +220,10 @@ def normalise_quantity(value) -> int:
 def serialise_options(options) -> str:
     if options is None:
         return "[]"
+    if isinstance(options, str) and options.lstrip().startswith(("[", "{")):
+        return options
     try:
-        return json.dumps(options, ensure_ascii=False, separators=(",", ":"))
+        return json_dumps(options)
     except TypeError:
         return "[]"
 
@@ -113,9 +231,10 @@ def serialise_options(options) -> str:
 def ensure_dict(value):
     if isinstance(value, dict):
         return value
-    if isinstance(value, str):
+    # Only an object literal can decode to a dict, so skip the parser otherwise.
+    if isinstance(value, str) and value.lstrip().startswith("{"):
         try:
-            parsed = json.loads(value)
+            parsed = json_loads(value)
             if isinstance(parsed, dict):
                 return parsed
         except (TypeError, ValueError, json.JSONDecodeError):
@@ -126,9 +245,10 @@ def ensure_dict(value):
 def ensure_list(value):
     if isinstance(value, list):
         return value
-    if isinstance(value, str):
+    # Likewise only an array literal can decode to a list.
+    if isinstance(value, str) and value.lstrip().startswith("["):
         try:
-            parsed = json.loads(value)
+            parsed = json_loads(value)
             if isinstance(parsed, list):
                 return parsed
         except (TypeError, ValueError, json.JSONDecodeError):
@@ -142,86 +262,61 @@ def extract_json_data(payload: dict) -> dict:
 
 
 def extract_file_found(payload: dict) -> int:
-    value = payload.get("file_found") or payload.get("fileFound")
-    return 1 if bool(value) else 0
+    return 1 if payload.get("file_found") or payload.get("fileFound") else 0
 
 
 def extract_buyer_note(payload: dict, json_data: dict, fallback: str = "") -> str:
-    for key in ("buyerNotes", "customerNotes", "note_from_buyer", "noteFromBuyer"):
-        value = payload.get(key)
-        if isinstance(value, str) and value.strip():
-            return value.strip()
+    note = next(
+        (
+            stripped
+            for source, keys in ((payload, ITEM_NOTE_KEYS), (json_data, JSON_DATA_NOTE_KEYS))
+            for key in keys
+            if isinstance(value := source.get(key), str) and (stripped := value.strip())
+        ),
+        None,
+    )
+    return note or fallback or ""
 
-    for key in ("customerNotes", "note_from_buyer", "noteFromBuyer"):
-        value = json_data.get(key)
-        if isinstance(value, str) and value.strip():
-            return value.strip()
 
-    return fallback or ""
+def normalise_year(value) -> str | None:
+    if value is None:
+        return None
+    if isinstance(value, int):
+        value = str(value)
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    if not value:
+        return None
+    match = YEAR_RE.search(value)
+    if match:
+        return match.group(1)
+    return None
 
 
 def extract_year(payload: dict, json_data: dict, fallback: str = "") -> str:
-    def normalise_year(value) -> str | None:
-        if value is None:
-            return None
-        if isinstance(value, int):
-            value = str(value)
-        if not isinstance(value, str):
-            return None
-        value = value.strip()
-        if not value:
-            return None
-        match = re.search(r"(20\\d{2}|19\\d{2})", value)
-        if match:
-            return match.group(1)
-        return None
-
-    for key in ("year", "Year"):
-        direct = payload.get(key)
-        result = normalise_year(direct)
-        if result:
-            return result
-
-    for options_key in ("options", "extendedOptions"):
-        options = ensure_list(payload.get(options_key) or [])
-        for option in options:
-            name = str(option.get("name") or "").lower()
-            if "year" in name:
-                result = normalise_year(option.get("value"))
-                if result:
-                    return result
-
-    for key in ("year", "Year"):
-        direct = json_data.get(key)
-        result = normalise_year(direct)
-        if result:
-            return result
-
-    for options_key in ("options", "extendedOptions"):
-        options = ensure_list(json_data.get(options_key) or [])
-        for option in options:
-            name = str(option.get("name") or "").lower()
-            if "year" in name:
-                result = normalise_year(option.get("value"))
-                if result:
-                    return result
+    # Item fields win over jsonData; within each source a direct year key wins
+    # over year-named options, whose lists are only decoded when needed.
+    for source in (payload, json_data):
+        for key in YEAR_KEYS:
+            result = normalise_year(source.get(key))
+            if result:
+                return result
+
+        for options_key in OPTION_KEYS:
+            for option in ensure_list(source.get(options_key) or []):
+                if "year" in str(option.get("name") or "").lower():
+                    result = normalise_year(option.get("value"))
+                    if result:
+                        return result
 
     return fallback or "2025"
 
 
-def backfill_item_metadata(conn: sqlite3.Connection) -> None:
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT order_number, item_id, raw_json,
-               COALESCE(product, ''), quantity, options, file_found, custom_field1, buyer_note, year,
-               requested_proof, needs_manual_review
-        FROM order_items
-        """
-    )
-    rows = cur.fetchall()
+BackfillUpdate = Tuple[int, str, int, str, str, str, str, int, int, str, str]
+
 
-    updates: List[Tuple[int, str, int, str, str, str, str, str, str, int, int]] = []
+def iter_backfill_updates(rows: Iterable[tuple]) -> Iterator[BackfillUpdate]:
     for (
         order_number,
         item_id,
@@ -235,9 +330,13 @@ def backfill_item_metadata(conn: sqlite3.Connection) -> None:
         year,
         requested_proof,
         needs_manual_review,
+        names,
     ) in rows:
+        # Only a JSON object is usable; skip anything else before parsing it.
+        if not raw_json or not JSON_OBJECT_START_RE.match(raw_json):
+            continue
         try:
-            payload = json.loads(raw_json)
+            payload = json_loads(raw_json)
         except json.JSONDecodeError:
             continue
 
@@ -248,7 +347,9 @@ def backfill_item_metadata(conn: sqlite3.Connection) -> None:
             new_custom_field1 = ""
 
         new_buyer_note = extract_buyer_note(payload, json_data, buyer_note or "")
-        new_year = extract_year(payload, json_data, year or "")
+        # Once parsed, the year is the model's answer and is left alone (as in
+        # download.UPSERT_SQL).
+        new_year = year if names and year else extract_year(payload, json_data, year or "")
         new_requested_proof = int(bool(requested_proof))
         new_manual_review = int(bool(needs_manual_review))
 
@@ -261,22 +362,20 @@ def backfill_item_metadata(conn: sqlite3.Connection) -> None:
             quantity_candidate = json_data.get("quantity") or json_data.get("qty")
         new_quantity = normalise_quantity(quantity_candidate) or quantity or 0
 
-        options_source = (
-            payload.get("options")
-            if payload.get("options") is not None
-            else json_data.get("options")
-        )
-        if options_source is not None:
-            new_options = serialise_options(options_source)
-        else:
-            new_options = options if options not in (None, "") else "[]"
+        current_options = options if options not in (None, "") else "[]"
+        options_source = payload.get("options")
+        if options_source is None:
+            options_source = json_data.get("options")
+        # Already-encoded option strings pass through serialise_options
+        # untouched, so only list/dict sources pay for an encode.
+        new_options = serialise_options(options_source) if options_source is not None else current_options
 
         changed = False
         if new_product != (product or ""):
             changed = True
         if new_quantity != (quantity or 0):
             changed = True
-        if new_options != (options if options not in (None, "") else "[]"):
+        if new_options != current_options:
             changed = True
         if new_file_found != (file_found or 0):
             changed = True
@@ -289,32 +388,58 @@ def backfill_item_metadata(conn: sqlite3.Connection) -> None:
             changed = True
 
         if changed:
-            updates.append(
-                (
-                    new_file_found,
-                    new_product,
-                    new_quantity,
-                    new_options,
-                    new_custom_field1,
-                    new_buyer_note,
-                    new_year,
-                    new_requested_proof,
-                    new_manual_review,
-                    order_number,
-                    item_id,
-                )
+            yield (
+                new_file_found,
+                new_product,
+                new_quantity,
+                new_options,
+                new_custom_field1,
+                new_buyer_note,
+                new_year,
+                new_requested_proof,
+                new_manual_review,
+                order_number,
+                item_id,
             )
 
-    if updates:
-        cur.executemany(
-            """
-            UPDATE order_items
-            SET file_found = ?, product = ?, quantity = ?, options = ?, custom_field1 = ?, buyer_note = ?, year = ?, requested_proof = ?, needs_manual_review = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE order_number = ? AND item_id = ?
-            """,
-            updates,
-        )
-        conn.commit()
+
+def backfill_item_metadata(conn: sqlite3.Connection, incomplete_only: bool = True) -> None:
+    where_clause = f"WHERE {BACKFILL_TODO_WHERE}" if incomplete_only else ""
+    rows = conn.execute(
+        f"""
+        SELECT order_number, item_id, raw_json,
+               COALESCE(product, ''), quantity, options, file_found, custom_field1, buyer_note, year,
+               requested_proof, needs_manual_review, names
+        FROM order_items
+        {where_clause}
+        """
+    )
+    write_cur = conn.cursor()
+
+    # Updates are produced lazily from the streaming SELECT and written in
+    # fixed-size chunks, so memory stays flat on large tables.
+    updates = iter_backfill_updates(rows)
+    while chunk := list(islice(updates, BACKFILL_BATCH_SIZE)):
+        write_backfill_updates(conn, write_cur, chunk)
+
+
+@lru_cache(maxsize=8)
+def backfill_update_from_values_sql(row_count: int) -> str:
+    row = "(" + ",".join("?" * BACKFILL_UPDATE_COLUMNS) + ")"
+    return BACKFILL_UPDATE_FROM_VALUES_SQL.format(rows=",".join([row] * row_count))
+
+
+def write_backfill_updates(conn: sqlite3.Connection, cur: sqlite3.Cursor, updates: Sequence[tuple]) -> None:
+    if sqlite3.sqlite_version_info < (3, 33, 0):
+        cur.executemany(BACKFILL_UPDATE_SQL, updates)
+        return
+
+    getlimit = getattr(conn, "getlimit", None)  # Python 3.11+
+    max_variables = getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER) if getlimit else 999
+    rows_per_statement = max(1, min(BACKFILL_BATCH_SIZE, max_variables // BACKFILL_UPDATE_COLUMNS))
+    for start in range(0, len(updates), rows_per_statement):
+        chunk = updates[start : start + rows_per_statement]
+        cur.execute(backfill_update_from_values_sql(len(chunk)), [value for row in chunk for value in row])
 
 
 def parse_args() -> argparse.Namespace:
@@ -332,12 +457,21 @@ def parse_args() -> argparse.Namespace:
 def initialise_database(db_path: Path) -> None:
     db_path.parent.mkdir(parents=True, exist_ok=True)
 
-    conn = sqlite3.connect(db_path)
+    # Autocommit mode: the only transaction is the explicit one around the
+    # backfill, so the driver never opens implicit ones around each statement.
+    conn = sqlite3.connect(db_path, isolation_level=None, cached_statements=256)
     try:
-        ensure_table(conn)
-        ensure_columns(conn)
-        ensure_indexes(conn)
-        backfill_item_metadata(conn)
+        configure_connection(conn)
+        previous_version = ensure_schema(conn)
+        # The whole backfill is one transaction: a single commit (and WAL sync)
+        # however many chunks it writes, and nothing is applied if it fails.
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            backfill_item_metadata(conn, incomplete_only=previous_version >= FULL_BACKFILL_VERSION)
+            # The version only moves past a pending repair once it commits.
+            if previous_version != SCHEMA_VERSION:
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        refresh_statistics(conn)
     finally:
         conn.close()
 
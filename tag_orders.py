@@ -5,11 +5,15 @@ from __future__ import annotations
 import argparse
 import os
 import sqlite3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Iterable, List, Optional, Sequence, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 DEFAULT_PRODUCT = "3d-Christmas-Tree-Ornament"
 API_URL = "https://ssapi.shipstation.com/orders/addtag"
@@ -18,6 +22,35 @@ GEN_TAG_ID = int(os.getenv("SS_GENERATED_TAG_ID", "130516"))
 SECONDARY_TAG_ID = int(os.getenv("SS_SECONDARY_TAG_ID", "76648"))
 MANUAL_TAG_ID = int(os.getenv("SS_MANUAL_TAG_ID", "130517"))
 RATE_LIMIT_THRESHOLD = int(os.getenv("SS_RATE_LIMIT_THRESHOLD", "15"))
+REQUEST_TIMEOUT = 10
+MAX_TAG_WORKERS = 4
+
+# An item needs a human when a proof or review was requested or generation failed.
+MANUAL_ITEM_CONDITION = (
+    "(requested_proof != 0 OR needs_manual_review != 0"
+    " OR (generation_error IS NOT NULL AND TRIM(generation_error) != ''))"
+)
+# Stay below SQLite's default 999 bound-variable limit per statement.
+MARK_TAGGED_CHUNK_SIZE = 900
+
+
+def build_session() -> requests.Session:
+    # Adding a tag twice is harmless, so POSTs are safe to retry.
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_TAG_WORKERS, max_retries=retry)
+    session = requests.Session()
+    session.headers.update({"Host": "ssapi.shipstation.com", "Content-Type": "application/json"})
+    session.mount("https://", adapter)
+    return session
+
+
+SESSION = build_session()
 
 
 def parse_order_id_selector(selector: str) -> List[str]:
@@ -29,48 +62,17 @@ def parse_order_id_selector(selector: str) -> List[str]:
     return values
 
 
-def fetch_manual_orders(
+def fetch_taggable_orders(
     conn: sqlite3.Connection,
     product: str,
     order_ids: Sequence[str],
     limit: Optional[int],
-) -> List[Tuple[str, str]]:
-    clauses = [
-        "order_id IS NOT NULL",
-        "TRIM(order_id) != ''",
-        "tags_applied = 0",
-        "product = ?",
-        "(requested_proof != 0 OR needs_manual_review != 0 OR (generation_error IS NOT NULL AND TRIM(generation_error) != ''))",
-    ]
-    params: List[object] = [product]
+) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+    """Return (manual, generated) orders from a single grouped scan.
 
-    if order_ids:
-        placeholders = ",".join("?" for _ in order_ids)
-        clauses.append(f"order_id IN ({placeholders})")
-        params.extend(order_ids)
-
-    query = f"""
-        SELECT order_id, MIN(order_number) AS order_number
-        FROM order_items
-        WHERE {' AND '.join(clauses)}
-        GROUP BY order_id
-        ORDER BY order_id ASC
+    Manual orders come first and use up the limit before generated ones, as
+    when the two lists were fetched separately.
     """
-    if limit is not None:
-        query += " LIMIT ?"
-        params.append(limit)
-
-    cursor = conn.cursor()
-    cursor.execute(query, params)
-    return [(row[0], row[1]) for row in cursor.fetchall()]
-
-
-def fetch_generated_orders(
-    conn: sqlite3.Connection,
-    product: str,
-    order_ids: Sequence[str],
-    limit: Optional[int],
-) -> List[Tuple[str, str]]:
     clauses = [
         "order_id IS NOT NULL",
         "TRIM(order_id) != ''",
@@ -85,37 +87,45 @@ def fetch_generated_orders(
         params.extend(order_ids)
 
     query = f"""
+        WITH per_order AS (
+            SELECT
+                order_id,
+                MIN(order_number) AS order_number,
+                MIN(CASE WHEN {MANUAL_ITEM_CONDITION} THEN order_number END) AS manual_order_number,
+                SUM(CASE WHEN {MANUAL_ITEM_CONDITION} THEN 1 ELSE 0 END) AS manual_count,
+                SUM(CASE WHEN is_generated = 1 AND (generation_error IS NULL OR TRIM(generation_error) = '') THEN 1 ELSE 0 END) AS success_count,
+                COUNT(*) AS total_count
+            FROM order_items
+            WHERE {' AND '.join(clauses)}
+            GROUP BY order_id
+        )
         SELECT
             order_id,
-            MIN(order_number) AS order_number,
-            SUM(CASE WHEN is_generated = 1 AND (generation_error IS NULL OR TRIM(generation_error) = '') THEN 1 ELSE 0 END) AS success_count,
-            COUNT(*) AS total_count,
-            SUM(CASE WHEN requested_proof != 0 OR needs_manual_review != 0 THEN 1 ELSE 0 END) AS manual_flags
-        FROM order_items
-        WHERE {' AND '.join(clauses)}
-        GROUP BY order_id
-        HAVING success_count = total_count AND manual_flags = 0
-        ORDER BY order_id ASC
+            CASE WHEN manual_count > 0 THEN manual_order_number ELSE order_number END,
+            manual_count > 0 AS is_manual
+        FROM per_order
+        WHERE manual_count > 0 OR success_count = total_count
+        ORDER BY is_manual DESC, order_id ASC
     """
     if limit is not None:
         query += " LIMIT ?"
         params.append(limit)
 
-    cursor = conn.cursor()
-    cursor.execute(query, params)
-    return [(row[0], row[1]) for row in cursor.fetchall()]
+    manual: List[Tuple[str, str]] = []
+    generated: List[Tuple[str, str]] = []
+    for order_id, order_number, is_manual in conn.execute(query, params):
+        (manual if is_manual else generated).append((order_id, order_number))
+    return manual, generated
 
 
 def add_tag(order_id: str, tag_id: int) -> Tuple[bool, Optional[int], Optional[int], Optional[str]]:
     headers = {
-        "Host": "ssapi.shipstation.com",
         "Authorization": os.getenv("SS_KEY", ""),
-        "Content-Type": "application/json",
         "x-partner": os.getenv("X_PARTNER_KEY", ""),
     }
     payload = {"orderId": order_id, "tagId": tag_id}
 
-    response = requests.post(API_URL, headers=headers, json=payload)
+    response = SESSION.post(API_URL, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
     remaining = response.headers.get("X-Rate-Limit-Remaining")
     reset = response.headers.get("X-Rate-Limit-Reset")
 
@@ -133,13 +143,38 @@ def add_tag(order_id: str, tag_id: int) -> Tuple[bool, Optional[int], Optional[i
     return response.ok, remaining_int, reset_int, error_text
 
 
+class RateLimiter:
+    """Pause every worker until the reset once ShipStation's remaining budget runs low."""
+
+    def __init__(self, threshold: int) -> None:
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def wait(self) -> None:
+        while True:
+            with self._lock:
+                delay = self._resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def update(self, remaining: Optional[int], reset: Optional[int]) -> Optional[int]:
+        if remaining is None or remaining > self.threshold or reset is None:
+            return None
+        sleep_for = max(reset + 1, 1)
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + sleep_for)
+        return sleep_for
+
+
 def apply_tags(
-    cursor: sqlite3.Cursor,
     order_id: str,
     order_number: str,
     tag_ids: Sequence[int],
     dry_run: bool,
     verbose: bool,
+    limiter: RateLimiter,
 ) -> bool:
     if not tag_ids:
         return True
@@ -150,6 +185,7 @@ def apply_tags(
                 print(f"[DRY-RUN] Would apply tag {tag_id} to order {order_id} ({order_number})")
             continue
 
+        limiter.wait()
         ok, remaining, reset, error_text = add_tag(order_id, tag_id)
         if not ok:
             print(f"[ERROR] Failed to apply tag {tag_id} to order {order_id}: {error_text}")
@@ -158,25 +194,26 @@ def apply_tags(
         if verbose:
             print(f"Applied tag {tag_id} to order {order_id}. Remaining={remaining} reset={reset}")
 
-        if remaining is not None and remaining <= RATE_LIMIT_THRESHOLD and reset is not None:
-            sleep_for = max(reset + 1, 1)
-            if verbose:
-                print(f"Rate limit low ({remaining}); sleeping {sleep_for}s")
-            time.sleep(sleep_for)
+        sleep_for = limiter.update(remaining, reset)
+        if sleep_for is not None and verbose:
+            print(f"Rate limit low ({remaining}); pausing requests for {sleep_for}s")
 
     return True
 
 
-def mark_tagged(cursor: sqlite3.Cursor, order_id: str) -> None:
-    cursor.execute(
-        """
-        UPDATE order_items
-        SET tags_applied = 1,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE order_id = ?
-        """,
-        (order_id,),
-    )
+def mark_tagged(cursor: sqlite3.Cursor, order_ids: Sequence[str]) -> None:
+    for start in range(0, len(order_ids), MARK_TAGGED_CHUNK_SIZE):
+        chunk = order_ids[start : start + MARK_TAGGED_CHUNK_SIZE]
+        placeholders = ",".join("?" for _ in chunk)
+        cursor.execute(
+            f"""
+            UPDATE order_items
+            SET tags_applied = 1,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE order_id IN ({placeholders})
+            """,
+            chunk,
+        )
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -221,65 +258,46 @@ def main(argv: Optional[Iterable[str]] = None) -> int:
     order_ids = parse_order_id_selector(args.order_ids) if args.order_ids else []
 
     try:
-        remaining = args.limit if args.limit is not None else None
-
-        manual_orders = fetch_manual_orders(
+        manual_orders, generated_orders = fetch_taggable_orders(
             conn=conn,
             product=args.product,
             order_ids=order_ids,
-            limit=remaining,
+            limit=args.limit,
         )
 
-        if remaining is not None:
-            remaining = max(remaining - len(manual_orders), 0)
-
-        generated_orders: List[Tuple[str, str]] = []
-        if remaining is None or remaining > 0:
-            gen_limit = remaining if remaining is not None else None
-            generated_orders = fetch_generated_orders(
-                conn=conn,
-                product=args.product,
-                order_ids=order_ids,
-                limit=gen_limit,
-            )
-
         processed = 0
         successes = 0
         failures = 0
+        tagged_ids: List[str] = []
 
-        for order_id, order_number in manual_orders:
-            if args.verbose:
-                print(f"Applying manual tag to order {order_id} ({order_number})")
-            success = apply_tags(
-                cursor=cursor,
-                order_id=order_id,
-                order_number=order_number,
-                tag_ids=[MANUAL_TAG_ID],
-                dry_run=args.dry_run,
-                verbose=args.verbose,
-            )
-            if success:
-                if not args.dry_run:
-                    mark_tagged(cursor, order_id)
-                successes += 1
-            else:
-                failures += 1
-            processed += 1
+        jobs = [(order_id, order_number, [MANUAL_TAG_ID], "manual tag") for order_id, order_number in manual_orders]
+        jobs += [
+            (order_id, order_number, [SECONDARY_TAG_ID, GEN_TAG_ID], "generated tags")
+            for order_id, order_number in generated_orders
+        ]
+        limiter = RateLimiter(RATE_LIMIT_THRESHOLD)
 
-        for order_id, order_number in generated_orders:
+        def run_job(job: Tuple[str, str, List[int], str]) -> bool:
+            order_id, order_number, tag_ids, label = job
             if args.verbose:
-                print(f"Applying generated tags to order {order_id} ({order_number})")
-            success = apply_tags(
-                cursor=cursor,
+                print(f"Applying {label} to order {order_id} ({order_number})")
+            return apply_tags(
                 order_id=order_id,
                 order_number=order_number,
-                tag_ids=[SECONDARY_TAG_ID, GEN_TAG_ID],
+                tag_ids=tag_ids,
                 dry_run=args.dry_run,
                 verbose=args.verbose,
+                limiter=limiter,
             )
+
+        # Orders are tagged concurrently; each order's own tags stay in sequence.
+        with ThreadPoolExecutor(max_workers=MAX_TAG_WORKERS) as executor:
+            results = list(executor.map(run_job, jobs))
+
+        for (order_id, _, _, _), success in zip(jobs, results):
             if success:
                 if not args.dry_run:
-                    mark_tagged(cursor, order_id)
+                    tagged_ids.append(order_id)
                 successes += 1
             else:
                 failures += 1
@@ -288,6 +306,8 @@ def main(argv: Optional[Iterable[str]] = None) -> int:
         if args.dry_run:
             conn.rollback()
         else:
+            if tagged_ids:
+                mark_tagged(cursor, tagged_ids)
             conn.commit()
 
         print(